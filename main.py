@@ -1,6 +1,27 @@
+import copy
 import csv
+import os
 from lxml import etree
-from typing import List, Tuple
+from typing import Iterable, Iterator, NamedTuple, Set
+
+_PARSER = etree.XMLParser(collect_ids=False, huge_tree=True)
+
+class Device(NamedTuple):
+    """
+    A single row of device information read from the CSV file.
+    
+    Attributes:
+        module_name (str): The name of the module.
+        ip_address (str): The IP address of the module.
+        id_number (str): The index of the module in ENET_STAT_1stSYS_ID.
+        em_switch (str): The switch the module is connected to.
+        port (str): The switch port the module is connected to.
+    """
+    module_name: str
+    ip_address: str
+    id_number: str
+    em_switch: str
+    port: str
 
 class XMLManipulator:
     """
@@ -12,6 +33,10 @@ class XMLManipulator:
         root (etree.Element): The root element of the parsed XML tree.
     """
 
+    # Anchored to Programs on purpose: Add-On Instruction definitions carry their own
+    # RLLContent and precede Programs in an export, so a bare iter("RLLContent") hits them first
+    _FIND_RLL = etree.XPath("(./Controller/Programs/Program/Routines/Routine/RLLContent)[1]")
+
     def __init__(self, template_filename: str):
         """
         Initialize the XMLManipulator with the provided template filename.
@@ -20,7 +45,7 @@ class XMLManipulator:
             template_filename (str): The filename of the XML template to be manipulated.
         """
         self.template_filename = template_filename
-        self.tree = etree.parse(template_filename)
+        self.tree = etree.parse(template_filename, _PARSER)
         self.root = self.tree.getroot()
 
     def save_to_file(self, output_filename: str):
@@ -30,24 +55,80 @@ class XMLManipulator:
         Args:
             output_filename (str): The name of the file to save the modified XML content.
         """
-        self.tree.write(output_filename, pretty_print=True, xml_declaration=True, encoding="UTF-8")
+        self.tree.write(output_filename, pretty_print=False, xml_declaration=True, encoding="UTF-8")
+
+    def stream_to_file(self, output_filename: str, target: etree.Element, elements: Iterable[etree.Element]):
+        """
+        Save the XML tree to a file, streaming extra elements as trailing children of target.
+        
+        The elements are serialized one at a time with etree.xmlfile and are never
+        attached to the tree, so memory use does not grow with their number. The
+        document is written to a temporary file next to output_filename, which only
+        replaces output_filename once every element has been written, so an error
+        raised while producing the elements leaves any existing output untouched.
+        
+        Args:
+            output_filename (str): The name of the file to save the XML content.
+            target (etree.Element): The element of the tree that receives the extra children.
+            elements (Iterable[etree.Element]): The detached elements to write inside target.
+        """
+        path = set(target.iterancestors())
+        path.add(target)
+        temp_filename = f"{output_filename}.{os.getpid()}.tmp"
+        try:
+            with open(temp_filename, "wb") as f:
+                with etree.xmlfile(f, encoding="UTF-8") as xf:
+                    xf.write_declaration()
+                    if self.tree.docinfo.doctype:
+                        xf.write_doctype(self.tree.docinfo.doctype)
+                    for node in reversed(list(self.root.itersiblings(preceding=True))):
+                        xf.write(node)
+                    self._stream_element(xf, self.root, target, path, elements)
+                # xmlfile refuses to write anything after the root element is closed
+                for node in self.root.itersiblings():
+                    f.write(etree.tostring(node, encoding="UTF-8", xml_declaration=False, with_tail=False))
+            os.replace(temp_filename, output_filename)
+        except BaseException:
+            if os.path.exists(temp_filename):
+                os.remove(temp_filename)
+            raise
+
+    @classmethod
+    def _stream_element(cls, xf: "etree._IncrementalFileWriter", elem: etree.Element, target: etree.Element,
+                        path: Set[etree.Element], elements: Iterable[etree.Element]):
+        """
+        Write an element through an xmlfile writer, descending only into the path to target.
+        
+        Args:
+            xf (etree._IncrementalFileWriter): The etree.xmlfile writer.
+            elem (etree.Element): The element to write.
+            target (etree.Element): The element that receives the extra children.
+            path (Set[etree.Element]): The target element and its ancestors.
+            elements (Iterable[etree.Element]): The detached elements to write inside target.
+        """
+        with xf.element(elem.tag, dict(elem.attrib)):
+            if elem.text:
+                xf.write(elem.text)
+            for child in elem:
+                if child in path:
+                    cls._stream_element(xf, child, target, path, elements)
+                else:
+                    xf.write(child)
+            if elem is target:
+                for extra in elements:
+                    xf.write(extra)
+        if elem.tail and elem.getparent() is not None:
+            xf.write(elem.tail)
 
     def find_rllcontent(self):
         """
-        Find the RLLContent element by traversing the XML structure.
+        Find the RLLContent element using the precompiled XPath expression.
         
         Returns:
             etree.Element: The RLLContent element if found, otherwise None.
         """
-        for controller in self.root.findall("Controller"):
-            for program in controller.findall("Programs"):
-                for prog in program.findall("Program"):
-                    for routine in prog.findall("Routines"):
-                        for rtn in routine.findall("Routine"):
-                            rllcontent = rtn.find("RLLContent")
-                            if rllcontent is not None:
-                                return rllcontent
-        return None
+        res = self._FIND_RLL(self.root)
+        return res[0] if res else None
 
 class L5XParser:
     """
@@ -65,63 +146,88 @@ class L5XParser:
             xml_manipulator (XMLManipulator): An instance of XMLManipulator to handle XML operations.
         """
         self.xml_manipulator = xml_manipulator
+        self._rllcontent = None
+        # Number is left empty so the attribute order matches the exported rungs
+        self._rung_tpl = etree.Element("Rung", Use="Target", Number="", Type="N")
+        etree.SubElement(self._rung_tpl, "Comment")
+        etree.SubElement(self._rung_tpl, "Text")
+
+    def _get_rll(self):
+        """
+        Find the RLLContent element once and reuse it on later calls.
+        
+        Returns:
+            etree.Element: The RLLContent element if found, otherwise None.
+        """
+        if self._rllcontent is None:
+            self._rllcontent = self.xml_manipulator.find_rllcontent()
+        return self._rllcontent
 
     def clear_rungs(self):
         """
         Clear all Rung elements from the RLLContent element.
         """
-        rllcontent = self.xml_manipulator.find_rllcontent()
-        if rllcontent is not None:
-            for rung in rllcontent.findall("Rung"):
-                rllcontent.remove(rung)
+        rllcontent = self._get_rll()
+        if rllcontent is None:
+            return
+        for rung in list(rllcontent.iterchildren("Rung")):
+            rllcontent.remove(rung)
 
-    def add_rungs(self, devices: List[List[str]], output_filename: str):
+    def add_rungs(self, devices: Iterable[Device], output_filename: str):
         """
-        Add rungs to the RLLContent element for each device provided.
+        Save the template with rungs added to the RLLContent element for each device provided.
+        
+        The rungs are streamed to the output file as they are generated instead of
+        being attached to the template tree first.
         
         Args:
-            devices (List[List[str]]): A list of device information lists.
+            devices (Iterable[Device]): An iterable of device information rows.
             output_filename (str): The name of the file to save the modified XML content.
         """
-        rllcontent = self.xml_manipulator.find_rllcontent()
-        if rllcontent is not None:
-            next_rung_number = 1
-
-            for device in devices:
-                module_name, ip_address, id_number, em_switch, port = device
-                ip_formatted = ",".join(ip_address.split("."))
-
-                # Create the first rung
-                rung1_comment = (
-                    f"**************************\n{module_name}\n**************************\n"
-                    "Mapping of switch port inputs to IP Address"
-                )
-                rung1_content = "NOP();"
-                rung1 = self.create_rung_with_cdata(next_rung_number, rung1_comment, rung1_content)
-                rllcontent.append(rung1)
-                next_rung_number += 1
-
-                # Create the content for the second rung
-                module_name_length = len(module_name)
-                moves = [
-                    f"MOV({module_name_length}, ENET_STAT_1stSYS_ID[{id_number}].Description.LEN)"
-                ]
-                for index, char in enumerate(module_name):
-                    ascii_value = ord(char)
-                    moves.append(f"MOV({ascii_value}, ENET_STAT_1stSYS_ID[{id_number}].Description.DATA[{index}])")
-
-                # Combine all MOV commands into a single content string and wrap with additional square brackets
-                rung2_content = f"[{', '.join(moves)} ];"
-                rung2 = self.create_rung_with_cdata(next_rung_number, None, rung2_content)
-                rllcontent.append(rung2)
-                next_rung_number += 1
-
-        self.xml_manipulator.save_to_file(output_filename)
+        rllcontent = self._get_rll()
+        if rllcontent is None:
+            self.xml_manipulator.save_to_file(output_filename)
+            return
+        self.xml_manipulator.stream_to_file(output_filename, rllcontent, self.generate_rungs(devices))
 
-    @staticmethod
-    def create_rung_with_cdata(rung_number: int, comment: str, content: str) -> etree.Element:
+    def generate_rungs(self, devices: Iterable[Device]) -> Iterator[etree.Element]:
         """
-        Create a rung XML element with CDATA content.
+        Generate the rungs for each device provided.
+        
+        Args:
+            devices (Iterable[Device]): An iterable of device information rows.
+        
+        Yields:
+            etree.Element: The detached Rung elements, two per device.
+        """
+        next_rung_number = 1
+
+        for device in devices:
+            module_name = device.module_name
+            id_number = device.id_number
+
+            # Create the first rung
+            rung1_comment = (
+                f"**************************\n{module_name}\n**************************\n"
+                "Mapping of switch port inputs to IP Address"
+            )
+            rung1_content = "NOP();"
+            yield self.create_rung(next_rung_number, rung1_comment, rung1_content)
+            next_rung_number += 1
+
+            # Create the content for the second rung
+            prefix = f"ENET_STAT_1stSYS_ID[{id_number}].Description.DATA"
+            head = f"MOV({len(module_name)}, ENET_STAT_1stSYS_ID[{id_number}].Description.LEN)"
+            tail = [f"MOV({b}, {prefix}[{i}])" for i, b in enumerate(module_name.encode('ascii'))]
+
+            # Combine all MOV commands into a single content string and wrap with additional square brackets
+            rung2_content = "[" + ", ".join((head, *tail)) + " ];"
+            yield self.create_rung(next_rung_number, None, rung2_content)
+            next_rung_number += 1
+
+    def create_rung(self, rung_number: int, comment: str, content: str) -> etree.Element:
+        """
+        Create a rung XML element with CDATA content from the rung template.
         
         Args:
             rung_number (int): The rung number.
@@ -131,12 +237,13 @@ class L5XParser:
         Returns:
             etree.Element: The created Rung element.
         """
-        rung = etree.Element("Rung", Use="Target", Number=str(rung_number), Type="N")
+        rung = copy.deepcopy(self._rung_tpl)
+        rung.set("Number", str(rung_number))
+        rung[1].text = etree.CDATA(content)
         if comment:
-            comment_elem = etree.SubElement(rung, "Comment")
-            comment_elem.text = etree.CDATA(comment)
-        text = etree.SubElement(rung, "Text")
-        text.text = etree.CDATA(content)
+            rung[0].text = etree.CDATA(comment)
+        else:
+            del rung[0]
         return rung
 
 class DeviceParser:
@@ -145,22 +252,28 @@ class DeviceParser:
     """
 
     @staticmethod
-    def read_devices_from_csv(csv_filename: str) -> List[List[str]]:
+    def read_devices_from_csv(csv_filename: str) -> Iterator[Device]:
         """
-        Parse the CSV file containing device information.
+        Parse the CSV file containing device information, one row at a time.
         
         Args:
             csv_filename (str): The name of the CSV file containing device information.
         
-        Returns:
-            List[List[str]]: A list of device information lists.
+        Yields:
+            Device: The device information for each row.
+        
+        Raises:
+            ValueError: If a module name contains non-ASCII characters.
         """
-        devices = []
-        with open(csv_filename, newline='') as csvfile:
+        with open(csv_filename, newline='', buffering=1 << 20) as csvfile:
             reader = csv.reader(csvfile)
-            for row in reader:
-                devices.append(row)
-        return devices
+            for device in map(Device._make, reader):
+                if not device.module_name.isascii():
+                    raise ValueError(
+                        f"{csv_filename}, line {reader.line_num}: module name "
+                        f"{device.module_name!r} contains non-ASCII characters"
+                    )
+                yield device
 
 if __name__ == "__main__":
     template_filename = 'HMI_Lables_Template.L5X'